@@ -1,14 +1,25 @@
-import json
+import asyncio
+import functools
+import hashlib
+import math
+import os
 import traceback
+import uuid
+from collections.abc import AsyncIterator
 from dataclasses import dataclass
-from fastapi.responses import PlainTextResponse, StreamingResponse
+from pathlib import Path
+from fastapi.responses import (
+    ORJSONResponse,
+    PlainTextResponse,
+    Response,
+)
+import anyio
 import modal
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
-import requests
 from fastapi.middleware.cors import CORSMiddleware
 
-web_app = FastAPI()
+web_app = FastAPI(default_response_class=ORJSONResponse)
 
 web_app.add_middleware(
     CORSMiddleware,
@@ -18,14 +29,32 @@ web_app.add_middleware(
     allow_headers=["*"],
 )
 
+image = modal.Image.debian_slim().pip_install(
+    "fastapi[standard]",
+    "pydantic",
+    "httpx[http2]",
+    "orjson",
+    "sse-starlette",
+)
+
+# These are only installed in the container image, so `modal deploy` can
+# import this file without them.
+with image.imports():
+    import httpx
+    import orjson
+    from sse_starlette.sse import EventSourceResponse
+
 app = modal.App(
     "usaco-judge",
-    image=modal.Image.debian_slim().pip_install(
-        "fastapi[standard]", "pydantic", "requests"
-    ),
+    image=image,
     volumes={"/root/data_private": modal.Volume.from_name("usaco-problems")},
 )
 
+# Compiled executables and their run options are stored here once per
+# submission so that each judge_one input only carries a short key instead of
+# the whole binary.
+executables = modal.Dict.from_name("usaco-judge-executables", create_if_missing=True)
+
 COMPILE_URL = (
     "https://v3nuswv3poqzw6giv37wmrt6su0krxvt.lambda-url.us-east-1.on.aws/compile"
 )
@@ -36,113 +65,302 @@ LARGE_INPUT_URL = (
     "https://v3nuswv3poqzw6giv37wmrt6su0krxvt.lambda-url.us-east-1.on.aws/large-input"
 )
 
+# Containers are reused across calls, so keeping connections to the Lambda
+# alive saves a TLS handshake on every request after the first. judge_one runs
+# its test cases concurrently, which HTTP/2 lets share a single multiplexed
+# connection. Like the requests calls this replaced, there's no client-side
+# timeout; the Lambdas enforce their own limits. The client is created on first
+# use since httpx is only available in the container.
+@functools.lru_cache(maxsize=None)
+def get_http_client() -> "httpx.AsyncClient":
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=None,
+    )
+
+
+# Problem data on the volume doesn't change for the lifetime of a container,
+# so it's parsed once and reused across requests.
+@functools.lru_cache(maxsize=None)
+def get_usaco_problems_json() -> bytes:
+    return Path("data_private/usaco/problems.json").read_bytes()
 
+
+@functools.lru_cache(maxsize=None)
 def get_usaco_problems():
-    with open("data_private/usaco/problems.json", "r") as f:
-        return json.load(f)
+    return orjson.loads(get_usaco_problems_json())
 
 
+@functools.lru_cache(maxsize=None)
 def get_usaco_to_probgate_mapping():
-    with open("data_private/probgate/usaco_to_probgate_mapping.json", "r") as f:
-        return json.load(f)
+    return orjson.loads(
+        Path("data_private/probgate/usaco_to_probgate_mapping.json").read_bytes()
+    )
 
 
+@functools.lru_cache(maxsize=512)
 def get_probgate_problem(problem_id: str):
-    with open(f"data_private/probgate/problems/{problem_id}/config.json", "r") as f:
-        return json.load(f)
+    return orjson.loads(
+        Path(f"data_private/probgate/problems/{problem_id}/config.json").read_bytes()
+    )
 
 
 @dataclass
-class JudgeOneParams:
+class ExecutableSpec:
     executable: dict
     timeout_ms: int
     file_io_name: str
+
+
+async def fetch_executable_spec(executable_key: str) -> ExecutableSpec:
+    executable_spec = await executables.get.aio(executable_key)
+    if executable_spec is None:
+        raise KeyError(f"Executable {executable_key!r} not found")
+    return executable_spec
+
+
+# Caching the task rather than the result also lets test cases that ask for
+# the same executable concurrently share a single lookup.
+_executable_spec_tasks: dict[str, asyncio.Task[ExecutableSpec]] = {}
+
+
+def get_executable_spec(executable_key: str) -> asyncio.Task[ExecutableSpec]:
+    if executable_key in _executable_spec_tasks:
+        return _executable_spec_tasks[executable_key]
+
+    if len(_executable_spec_tasks) >= 16:
+        # Dicts keep insertion order, so this evicts the oldest entry
+        del _executable_spec_tasks[next(iter(_executable_spec_tasks))]
+
+    task = asyncio.ensure_future(fetch_executable_spec(executable_key))
+
+    def forget_failed_lookup(task: asyncio.Task[ExecutableSpec]):
+        # Don't let a failed lookup stick around for later batches
+        if (task.cancelled() or task.exception() is not None) and (
+            _executable_spec_tasks.get(executable_key) is task
+        ):
+            del _executable_spec_tasks[executable_key]
+
+    task.add_done_callback(forget_failed_lookup)
+    _executable_spec_tasks[executable_key] = task
+    return task
+
+
+def output_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+# Expected outputs are immutable, so only their digests are kept around
+# instead of re-reading the files for every submission. The file is read in
+# text mode so universal newlines normalize any \r\n line endings, and it is
+# stripped as a str to match how program output is stripped.
+@functools.lru_cache(maxsize=4096)
+def get_expected_output_digests(output_file_path: str) -> tuple[bytes, bytes]:
+    expected_output = Path(output_file_path).read_text()
+    return (
+        output_digest(expected_output.encode()),
+        output_digest(expected_output.strip().encode()),
+    )
+
+
+# SSE frames are built by concatenating these around the encoded payload
+_EXECUTE_PREFIX = b"event: execute\ndata: "
+_COMPILE_PREFIX = b"event: compile\ndata: "
+_ERROR_PREFIX = b"event: error\ndata: "
+_FRAME_SUFFIX = b"\n\n"
+
+# Outputs sent back to the client are clamped to this many characters. The
+# grader still needs the complete output, so this is applied after grading.
+MAX_OUTPUT_LENGTH = 10_000
+
+# Number of test cases handled by a single judge_one call. Test cases in a
+# batch are executed concurrently and streamed back as each one finishes, so
+# this trades per-call overhead for parallelism across containers.
+TEST_CASES_PER_BATCH = 4
+
+
+@dataclass
+class TestCaseParams:
     input_file_path: str
     output_file_path: str
     result_attrs: dict
 
 
-@app.function(region="us-east", cloud="aws")
-def judge_one(
-    params: JudgeOneParams,
-):
-    with open(params.input_file_path, "r") as f:
-        input_data = f.read()
-    with open(params.output_file_path, "r") as f:
-        output_data = f.read()
-
-    if len(input_data) > 2_000_000:
+@dataclass
+class JudgeBatchParams:
+    executable_key: str
+    test_cases: list[TestCaseParams]
+
+
+# Large inputs are read in text mode like small ones, so universal newlines
+# normalize \r\n line endings regardless of input size. Text mode also takes
+# care of a \r\n split across two chunks.
+def normalized_input_size(path: str, chunk_size: int = 1 << 20) -> int:
+    size = 0
+    with open(path, "r") as f:
+        while chunk := f.read(chunk_size):
+            size += len(chunk.encode())
+    return size
+
+
+async def read_normalized_chunks(path: str, chunk_size: int = 1 << 20):
+    with open(path, "r") as f:
+        while chunk := await asyncio.to_thread(f.read, chunk_size):
+            yield chunk.encode()
+
+
+async def judge_test_case(
+    executable_spec_task: asyncio.Task[ExecutableSpec], test_case: TestCaseParams
+) -> bytes:
+    input_size = os.path.getsize(test_case.input_file_path)
+    if input_size > 2_000_000:
         # There's a 6 MB limit for AWS lambda functions
-        response = requests.post(
+        response = await get_http_client().post(
             LARGE_INPUT_URL,
         )
-        result = response.json()
-        requests.put(
+        result = orjson.loads(response.content)
+        # Streaming the file avoids holding the whole input in memory. S3
+        # rejects chunked uploads, so the length is set explicitly.
+        upload_size = await asyncio.to_thread(
+            normalized_input_size, test_case.input_file_path
+        )
+        await get_http_client().put(
             result["presigned_url"],
-            data=input_data,
+            content=read_normalized_chunks(test_case.input_file_path),
+            headers={"Content-Length": str(upload_size)},
         )
         stdin, stdin_id = None, result["input_id"]
     else:
-        stdin, stdin_id = input_data, None
-
-    response = requests.post(
+        # Text mode is kept on purpose: stdin is sent as a JSON string, and
+        # universal newlines normalize any \r\n line endings in the test data
+        stdin = await asyncio.to_thread(Path(test_case.input_file_path).read_text)
+        stdin_id = None
+
+    # The executable is only needed for the execute call, so large inputs
+    # are uploaded while it's still being fetched
+    executable_spec = await executable_spec_task
+
+    # Bodies are encoded with orjson rather than through json=, which goes
+    # through the much slower stdlib encoder for the whole stdin payload
+    response = await get_http_client().post(
         EXECUTE_URL,
-        json={
-            "executable": params.executable,
-            "options": {
-                "stdin": stdin,
-                "stdin_id": stdin_id,
-                "timeout_ms": params.timeout_ms,
-                "file_io_name": params.file_io_name,
-            },
-        },
+        content=orjson.dumps(
+            {
+                "executable": executable_spec.executable,
+                "options": {
+                    "stdin": stdin,
+                    "stdin_id": stdin_id,
+                    "timeout_ms": executable_spec.timeout_ms,
+                    "file_io_name": executable_spec.file_io_name,
+                },
+            }
+        ),
         headers={"Content-Type": "application/json"},
     )
     try:
-        result = response.json()
+        result = orjson.loads(response.content)
 
         if result["full_output_url"] is not None:
-            response = requests.get(result["full_output_url"])
-            result = response.json()
-    except requests.JSONDecodeError:
+            response = await get_http_client().get(result["full_output_url"])
+            result = orjson.loads(response.content)
+    except orjson.JSONDecodeError:
         result = {"internal_error": response.text}
 
     if "internal_error" not in result:
         # Naive grader: Check for identical output
         if result["verdict"] == "accepted":
             output = result["file_output"] or result["stdout"]
-            if output.strip() != output_data.strip():
+            expected_digest, expected_stripped_digest = await asyncio.to_thread(
+                get_expected_output_digests, test_case.output_file_path
+            )
+            # Exact matches are the common case, so only strip on a mismatch.
+            # Stripping is done on the str so Unicode whitespace is still
+            # ignored, as before.
+            if (
+                output_digest(output.encode()) != expected_digest
+                and output_digest(output.strip().encode()) != expected_stripped_digest
+            ):
                 result["verdict"] = "wrong_answer"
 
-        result["stdout"] = result["stdout"][:10000]
-        result["stderr"] = result["stderr"][:10000]
+        result["stdout"] = result["stdout"][:MAX_OUTPUT_LENGTH]
+        result["stderr"] = result["stderr"][:MAX_OUTPUT_LENGTH]
         if result["file_output"] is not None:
-            result["file_output"] = result["file_output"][:10000]
+            result["file_output"] = result["file_output"][:MAX_OUTPUT_LENGTH]
 
-    result = {
-        **result,
-        **params.result_attrs,
-    }
+    result.update(test_case.result_attrs)
 
-    return f"event: execute\ndata: {json.dumps(result)}\n\n"
+    return _EXECUTE_PREFIX + orjson.dumps(result) + _FRAME_SUFFIX
 
 
-def compile(source_code: str, compiler_options: str, language: str):
-    response = requests.post(
+@app.function(region="us-east", cloud="aws")
+async def judge_one(
+    params: JudgeBatchParams,
+) -> AsyncIterator[bytes]:
+    if not params.test_cases:
+        # Warmup call, see _judge()
+        return
+
+    executable_spec_task = get_executable_spec(params.executable_key)
+    for frame in asyncio.as_completed(
+        [
+            judge_test_case(executable_spec_task, test_case)
+            for test_case in params.test_cases
+        ]
+    ):
+        yield await frame
+
+
+async def warm_up_judge_one(num_containers: int):
+    async def warm_up():
+        async for _ in judge_one.remote_gen.aio(
+            JudgeBatchParams(executable_key="", test_cases=[])
+        ):
+            pass
+
+    await asyncio.gather(*(warm_up() for _ in range(num_containers)))
+
+
+# Runs each batch on its own judge_one call and puts every frame on the queue as
+# soon as it arrives, followed by None once all batches are done. If a batch
+# fails, the exception is put on the queue instead.
+async def judge_batches(batches: list[JudgeBatchParams], queue: asyncio.Queue):
+
+    async def judge_batch(batch: JudgeBatchParams):
+        async for frame in judge_one.remote_gen.aio(batch):
+            await queue.put(frame)
+
+    try:
+        await asyncio.gather(*(judge_batch(batch) for batch in batches))
+    except Exception as e:
+        await queue.put(e)
+    else:
+        await queue.put(None)
+
+
+async def compile(source_code: str, compiler_options: str, language: str):
+    response = await get_http_client().post(
         COMPILE_URL,
-        json={
-            "source_code": source_code,
-            "compiler_options": compiler_options,
-            "language": language,
-        },
+        content=orjson.dumps(
+            {
+                "source_code": source_code,
+                "compiler_options": compiler_options,
+                "language": language,
+            }
+        ),
         headers={"Content-Type": "application/json"},
     )
     try:
-        return response.json()
-    except requests.JSONDecodeError:
+        return orjson.loads(response.content)
+    except orjson.JSONDecodeError:
         raise Exception(response.text)
 
 
+def log_warmup_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        print(f"judge_one warmup failed: {task.exception()!r}")
+
+
 class JudgeRequest(BaseModel):
     problem_id: str
     source_code: str
@@ -151,32 +369,47 @@ class JudgeRequest(BaseModel):
 
 
 @web_app.post("/judge")
-def judge(request: JudgeRequest):
-    problems = get_usaco_problems()
+async def judge(request: JudgeRequest):
+    # The loaders read from the volume on a cache miss (a cold container, or
+    # the first submission to a problem), so they run in a thread to avoid
+    # stalling other streams on the event loop.
+    problems = await asyncio.to_thread(get_usaco_problems)
     problem_id = request.problem_id
 
     if problem_id not in problems:
         raise HTTPException(status_code=404, detail="Problem not found")
 
-    usaco_to_probgate_mapping = get_usaco_to_probgate_mapping()
+    usaco_to_probgate_mapping = await asyncio.to_thread(get_usaco_to_probgate_mapping)
     if problem_id not in usaco_to_probgate_mapping:
         raise HTTPException(
             status_code=404, detail="We don't have test data for this problem yet."
         )
 
     probgate_problem_id = usaco_to_probgate_mapping[problem_id]
-    probgate_problem = get_probgate_problem(probgate_problem_id)
+    probgate_problem = await asyncio.to_thread(
+        get_probgate_problem, probgate_problem_id
+    )
 
-    def _judge():
+    async def _judge():
         try:
-            compile_result = compile(
+            # Start judge_one containers while the submission compiles, so
+            # they're already up by the time the test cases are dispatched.
+            # A failed warmup only means a slower first batch, so its errors
+            # are logged and otherwise ignored.
+            num_tests = len(probgate_problem["tests"])
+            num_batches = math.ceil(num_tests / TEST_CASES_PER_BATCH)
+            warmup = asyncio.create_task(warm_up_judge_one(num_batches))
+            warmup.add_done_callback(log_warmup_failure)
+
+            compile_result = await compile(
                 request.source_code, request.compiler_options, request.language
             )
 
             if "compile_output" in compile_result:
-                yield f"event: compile\ndata: {json.dumps(compile_result['compile_output'])}\n\n"
+                compile_output = compile_result["compile_output"]
             else:
-                yield f"event: compile\ndata: {json.dumps(compile_result)}\n\n"
+                compile_output = compile_result
+            yield _COMPILE_PREFIX + orjson.dumps(compile_output) + _FRAME_SUFFIX
 
             if (
                 "executable" not in compile_result
@@ -184,12 +417,18 @@ def judge(request: JudgeRequest):
             ):
                 return
 
-            yield from judge_one.map(
-                (
-                    JudgeOneParams(
-                        executable=compile_result["executable"],
-                        timeout_ms=probgate_problem["time_limit_ms"],
-                        file_io_name=probgate_problem["shortname"],
+            executable_key = uuid.uuid4().hex
+            await executables.put.aio(
+                executable_key,
+                ExecutableSpec(
+                    executable=compile_result["executable"],
+                    timeout_ms=probgate_problem["time_limit_ms"],
+                    file_io_name=probgate_problem["shortname"],
+                ),
+            )
+            try:
+                test_cases = [
+                    TestCaseParams(
                         input_file_path=f"data_private/probgate/problems/{probgate_problem_id}/{test_case['input']}",
                         output_file_path=f"data_private/probgate/problems/{probgate_problem_id}/{test_case['output']}",
                         result_attrs={
@@ -198,17 +437,44 @@ def judge(request: JudgeRequest):
                         },
                     )
                     for i, test_case in enumerate(probgate_problem["tests"])
-                ),
-                order_outputs=False,
-            )
+                ]
+                # Frames from all batches are merged through a queue so each
+                # test case is streamed as soon as it finishes, rather than
+                # waiting on the slowest test case in its batch.
+                queue = asyncio.Queue()
+                batches_task = asyncio.create_task(
+                    judge_batches(
+                        [
+                            JudgeBatchParams(
+                                executable_key=executable_key,
+                                test_cases=test_cases[i : i + TEST_CASES_PER_BATCH],
+                            )
+                            for i in range(0, len(test_cases), TEST_CASES_PER_BATCH)
+                        ],
+                        queue,
+                    )
+                )
+                try:
+                    while (frame := await queue.get()) is not None:
+                        if isinstance(frame, Exception):
+                            raise frame
+                        yield frame
+                finally:
+                    batches_task.cancel()
+            finally:
+                # If the client disconnects the stream is cancelled, which
+                # would also cancel this await and leak the executable
+                with anyio.CancelScope(shield=True):
+                    await executables.pop.aio(executable_key)
         except Exception as e:
             # Kinda dumb but we can't have newlines, so we use repr()
-            yield f"event: error\ndata: {repr(e)}. {repr(traceback.format_exc())}\n\n"
+            error = f"{repr(e)}. {repr(traceback.format_exc())}"
+            yield _ERROR_PREFIX + error.encode() + _FRAME_SUFFIX
 
-    return StreamingResponse(
-        _judge(),
-        media_type="text/event-stream",
-    )
+    # Events are yielded pre-framed as bytes, which EventSourceResponse passes
+    # through as-is. The ping keeps proxies from timing out the connection
+    # while slow test cases run.
+    return EventSourceResponse(_judge(), ping=15, sep="\n")
 
 
 @web_app.get("/")
@@ -218,8 +484,10 @@ async def root():
 
 @web_app.get("/usaco-problems.json")
 async def get_usaco_problems_route():
-    problems = get_usaco_problems()
-    return problems
+    return Response(
+        content=await asyncio.to_thread(get_usaco_problems_json),
+        media_type="application/json",
+    )
 
 
 @app.function(region="us-east")